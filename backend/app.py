@@ -5,10 +5,15 @@ HTTP エンドポイントとして SAM3D 推論を提供する Modal アプリ
 """
 
 import modal
-import io
-import base64
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Base64 デコードは pybase64 を優先（ローカル実行時など未インストールなら標準ライブラリ）
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 # Modal アプリケーション定義
 app = modal.App("sam3d-backend")
 
@@ -48,6 +53,7 @@ sam3d_image = (
         "trimesh",
         "plyfile",
         "huggingface_hub",
+        "pybase64",
     )
     # TODO: kaolin, gsplat, pytorch3d, MoGe を追加
     # これらは複雑なビルドが必要なため、段階的に追加する
@@ -56,6 +62,10 @@ sam3d_image = (
 # チェックポイント用 Volume
 checkpoint_volume = modal.Volume.from_name("sam3d-checkpoints", create_if_missing=True)
 
+# SAM3D モデルの組み込みが完了するまでは False。
+# False の間は /generate が GPU コンテナを起動せずにプレースホルダーを返す
+SAM3D_MODEL_READY = False
+
 # ========================================
 # 推論クラス
 # ========================================
@@ -74,67 +84,137 @@ class SAM3DInference:
     def setup(self):
         """コンテナ起動時にモデルをロード"""
         import os
+        import warnings
+
+        # 推論パスで使う重いモジュールはここで一度だけ import し、
+        # リクエストごとの import 処理を避ける
+        import torch
+        from torchvision.io import ImageReadMode, decode_image, decode_jpeg
+
+        self.torch = torch
+        self.ImageReadMode = ImageReadMode
+        self.decode_image = decode_image
+        self.decode_jpeg = decode_jpeg
+
+        # デコード済みの bytes を書き込み可能にするためだけにコピーしないよう、
+        # 読み取り専用バッファを torch.frombuffer に渡す際の警告を抑止する
+        # （デコーダは入力テンソルを読むだけで書き換えない）。
+        # catch_warnings はスレッドセーフでないため、デコードスレッドではなくここで一度だけ登録する
+        warnings.filterwarnings(
+            "ignore", message="The given buffer is not writable", category=UserWarning
+        )
+
+        # 画像・マスクのデコード用スレッドプール
+        # （PIL / torchvision のデコーダは GIL を解放するため、スレッドで並列化できる）
+        self.decode_pool = ThreadPoolExecutor(max_workers=8)
 
         # TODO: SAM3D モデルのロード
         # self.inference = Inference(config_path, compile=False)
         self.model_loaded = False
         print("SAM3D Inference: Setup complete (model loading pending)")
 
-    @modal.method()
-    def generate_3d(
+    def decode_base64_image(self, b64_str: str, mode: str, device: str = "cuda"):
+        """
+        Base64文字列を uint8 テンソル (C, H, W) にデコード
+
+        JPEG は nvJPEG で GPU 上で直接デコードし、ホスト側に画素バッファを作らない。
+        PNG などそれ以外の形式は CPU でデコードしてから GPU へ転送する。
+
+        Args:
+            b64_str: Base64 エンコードされた画像
+            mode: 出力モード ("RGB" or "L")
+            device: 出力テンソルのデバイス
+        """
+        raw = self.torch.frombuffer(base64.b64decode(b64_str), dtype=self.torch.uint8)
+        read_mode = self.ImageReadMode.RGB if mode == "RGB" else self.ImageReadMode.GRAY
+
+        # JPEG (SOI マーカー 0xFFD8) は GPU デコード
+        if raw.numel() >= 2 and raw[0] == 0xFF and raw[1] == 0xD8:
+            return self.decode_jpeg(raw, mode=read_mode, device=device)
+
+        return self.decode_image(raw, mode=read_mode).to(device, non_blocking=True)
+
+    @modal.batched(max_batch_size=8, wait_ms=50)
+    def generate_3d_batch(
         self,
-        image_base64: str,
-        mask_base64: str,
-        output_format: str = "ply",
-        seed: int = 42,
-    ) -> dict:
+        image_base64s: list[str],
+        mask_base64s: list[str],
+        output_formats: list[str],
+        seeds: list[int],
+    ) -> list[dict]:
         """
-        画像とマスクから 3D モデルを生成
+        画像とマスクから 3D モデルを生成（動的バッチ処理）
+
+        呼び出し側は 1 件ずつ `.remote()` で呼び出し、Modal が wait_ms 以内に
+        届いたリクエストを最大 max_batch_size 件まとめてこのメソッドに渡す。
 
         Args:
-            image_base64: Base64 エンコードされた RGB 画像
-            mask_base64: Base64 エンコードされた マスク画像
-            output_format: 出力形式 ("ply" or "glb")
-            seed: 乱数シード
+            image_base64s: Base64 エンコードされた RGB 画像のリスト
+            mask_base64s: Base64 エンコードされた マスク画像のリスト
+            output_formats: 出力形式 ("ply" or "glb") のリスト
+            seeds: 乱数シードのリスト
 
         Returns:
-            dict: {
+            list[dict]: 入力と同じ順序の結果リスト。各要素は {
                 "success": bool,
                 "file_base64": str (生成されたファイルの Base64),
                 "format": str,
                 "message": str
             }
         """
-        try:
-            from PIL import Image
-            import numpy as np
-
-            # Base64 デコード
-            image_bytes = base64.b64decode(image_base64)
-            mask_bytes = base64.b64decode(mask_base64)
-
-            image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-            mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
-
-            # TODO: SAM3D 推論を実行
-            # output = self.inference(image, mask, seed=seed)
-            # output["gs"].save_ply("output.ply")
-
-            # プレースホルダー: ダミーレスポンス
-            return {
-                "success": False,
-                "file_base64": "",
-                "format": output_format,
-                "message": "SAM3D model not yet loaded. This is a placeholder response.",
-            }
-
-        except Exception as e:
-            return {
-                "success": False,
-                "file_base64": "",
-                "format": output_format,
-                "message": f"Error: {str(e)}",
-            }
+        # モデル未ロードならデコード（GPU 転送）自体を行わずに返す
+        if not self.model_loaded:
+            return [
+                {
+                    "success": False,
+                    "file_base64": "",
+                    "format": output_format,
+                    "message": "SAM3D model not yet loaded. This is a placeholder response.",
+                }
+                for output_format in output_formats
+            ]
+
+        # Base64 デコード（バッチ内の全画像・マスクを並列に）
+        futures = [
+            (
+                self.decode_pool.submit(self.decode_base64_image, image_base64, "RGB"),
+                self.decode_pool.submit(self.decode_base64_image, mask_base64, "L"),
+            )
+            for image_base64, mask_base64 in zip(image_base64s, mask_base64s)
+        ]
+
+        results = []
+        images = []
+        masks = []
+        for (image_future, mask_future), output_format in zip(futures, output_formats):
+            try:
+                image, mask = image_future.result(), mask_future.result()
+                images.append(image)
+                masks.append(mask)
+                results.append(None)
+            except Exception as e:
+                results.append({
+                    "success": False,
+                    "file_base64": "",
+                    "format": output_format,
+                    "message": f"Error: {str(e)}",
+                })
+
+        # TODO: SAM3D 推論をバッチで実行
+        # outputs = self.inference(images, masks, seeds=seeds)
+        # output["gs"].save_ply("output.ply")
+
+        # プレースホルダー: ダミーレスポンス
+        for i, output_format in enumerate(output_formats):
+            if results[i] is None:
+                results[i] = {
+                    "success": False,
+                    "file_base64": "",
+                    "format": output_format,
+                    "message": "SAM3D model not yet loaded. This is a placeholder response.",
+                }
+
+        return results
 
 
 # ========================================
@@ -152,7 +232,8 @@ def health():
     }
 
 
-@app.function(image=sam3d_image, gpu="A100", timeout=600)
+# GPU は SAM3DInference 側で確保するため、エンドポイント自体は CPU で動かす
+@app.function(image=sam3d_image, timeout=600)
 @modal.web_endpoint(method="POST")
 def generate(request: dict):
     """
@@ -189,15 +270,25 @@ def generate(request: dict):
             "message": "Missing required fields: image and mask",
         }
 
-    # TODO: SAM3DInference クラスを呼び出す
-    # inference = SAM3DInference()
-    # result = inference.generate_3d.remote(image_b64, mask_b64, output_format, seed)
+    # モデル未組み込みの間は A100 をコールドスタートさせずに即座に返す
+    if not SAM3D_MODEL_READY:
+        return {
+            "success": False,
+            "file": "",
+            "format": output_format,
+            "message": "Endpoint is ready. SAM3D integration pending.",
+        }
+
+    # 1 件ずつ投入し、同時に届いたリクエストは Modal 側でバッチにまとめられる
+    result = SAM3DInference().generate_3d_batch.remote(
+        image_b64, mask_b64, output_format, seed
+    )
 
     return {
-        "success": False,
-        "file": "",
-        "format": output_format,
-        "message": "Endpoint is ready. SAM3D integration pending.",
+        "success": result["success"],
+        "file": result["file_base64"],
+        "format": result["format"],
+        "message": result["message"],
     }
 
 
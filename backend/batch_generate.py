@@ -27,28 +27,73 @@
 """
 
 import argparse
-import base64
+import asyncio
+import io
 import os
 import sys
 import time
+from collections import defaultdict
 from pathlib import Path
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+import msgpack
+from PIL import Image
+
+# 受信したモデルデータのデコード用（pybase64 が無ければ標準の base64）
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # Modal SAM3D サーバーURL
 DEFAULT_SERVER_URL = "https://cryptor--sam3d-generation-server-web-app.modal.run"
 
+# Base64 デコードのチャンクサイズ（4文字単位で区切れるよう4の倍数にする）
+DECODE_CHUNK_SIZE = 4 * 65536
+
 
-def load_image_as_base64(path: Path) -> str:
-    """画像ファイルをBase64エンコードして返す"""
+def load_image_bytes(path: Path, max_side: int = 0, is_mask: bool = False) -> bytes:
+    """
+    画像ファイルを bytes として読み込む（msgpack でそのまま送信する）
+    
+    長辺が max_side を超える画像はアップロード前に縮小する（0 の場合は縮小しない）。
+    元画像は JPEG (q=90)、マスクは2値ラベルを保つため最近傍補間 + PNG で保存する
+    """
+    if max_side > 0:
+        with Image.open(path) as img:
+            # Image.open はヘッダーのみ読むため、サイズ確認ではデコードしない
+            if max(img.size) > max_side:
+                if is_mask:
+                    # reducing_gap を無効にし、平均化による中間値の発生を防ぐ
+                    img.thumbnail((max_side, max_side), Image.NEAREST, reducing_gap=None)
+                    fmt, options = "PNG", {}
+                else:
+                    img.thumbnail((max_side, max_side), Image.BILINEAR)
+                    if img.mode not in ("RGB", "L"):
+                        img = img.convert("RGB")
+                    fmt, options = "JPEG", {"quality": 90}
+                
+                buffer = io.BytesIO()
+                img.save(buffer, format=fmt, **options)
+                return buffer.getvalue()
+    
     with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        return f.read()
 
 
-def save_model_from_base64(data: str, path: Path):
-    """Base64エンコードされたモデルデータをファイルに保存"""
+def save_model_data(data: str | bytes, path: Path):
+    """
+    モデルデータをファイルに保存
+    
+    bytes（msgpack レスポンス）はそのまま書き込む。
+    Base64 文字列はチャンク単位でデコードして書き込むため、デコード済みデータ全体を
+    メモリ上に保持しない（大きなメッシュでもピークメモリが倍増しない）
+    """
     with open(path, "wb") as f:
-        f.write(base64.b64decode(data))
+        if isinstance(data, bytes):
+            f.write(data)
+            return
+        for start in range(0, len(data), DECODE_CHUNK_SIZE):
+            f.write(base64.b64decode(data[start:start + DECODE_CHUNK_SIZE]))
 
 
 def find_image_mask_pairs(input_dir: Path) -> list[tuple[Path, Path, str]]:
@@ -60,125 +105,152 @@ def find_image_mask_pairs(input_dir: Path) -> list[tuple[Path, Path, str]]:
     """
     pairs = []
     
+    # ディレクトリを1回だけ走査し、以降の存在確認はセット参照で行う（statを発行しない）
+    with os.scandir(input_dir) as it:
+        file_names = sorted(entry.name for entry in it if entry.is_file())
+    names = set(file_names)
+    
     # パターン1: original_image.png + Object_X_mask.png
-    original = input_dir / "original_image.png"
-    if not original.exists():
-        # 他の一般的な名前も試す
-        for name in ["original.png", "image.png", "source.png"]:
-            alt = input_dir / name
-            if alt.exists():
-                original = alt
-                break
+    # 他の一般的な名前も試す
+    original = None
+    for name in ["original_image.png", "original.png", "image.png", "source.png"]:
+        if name in names:
+            original = input_dir / name
+            break
     
-    if original.exists():
+    if original is not None:
         # original_image があれば、*_mask.png をすべて見つける
-        for mask_path in input_dir.glob("*_mask.png"):
+        for file_name in file_names:
+            if not file_name.endswith("_mask.png"):
+                continue
             # マスクファイル名からオブジェクト名を取得
-            name = mask_path.stem.replace("_mask", "")
+            name = file_name[:-len(".png")].replace("_mask", "")
             if name != "original_image" and name != "original":
-                pairs.append((original, mask_path, name))
+                pairs.append((original, input_dir / file_name, name))
     
     # パターン2: image.png + image_mask.png のペア
-    if not pairs:
-        for img_path in input_dir.glob("*.png"):
-            if "_mask" in img_path.stem:
-                continue
-            mask_path = input_dir / f"{img_path.stem}_mask.png"
-            if mask_path.exists():
-                pairs.append((img_path, mask_path, img_path.stem))
-    
     # パターン3: JPGも対応
-    if not pairs:
-        for img_path in input_dir.glob("*.jpg"):
-            mask_path = input_dir / f"{img_path.stem}_mask.png"
-            if mask_path.exists():
-                pairs.append((img_path, mask_path, img_path.stem))
+    for ext in [".png", ".jpg"]:
+        if pairs:
+            break
+        for file_name in file_names:
+            if not file_name.endswith(ext):
+                continue
+            stem = file_name[:-len(ext)]
+            if "_mask" in stem:
+                continue
+            mask_name = f"{stem}_mask.png"
+            if mask_name in names:
+                pairs.append((input_dir / file_name, input_dir / mask_name, stem))
     
     return pairs
 
 
-def generate_3d(
+async def generate_3d(
+    client: httpx.AsyncClient,
     image_path: Path,
-    mask_path: Path,
-    name: str,
+    masks: list[tuple[Path, str]],
     output_dir: Path,
     server_url: str,
     output_format: str = "ply",
     seed: int = 42,
-) -> dict:
+    max_side: int = 0,
+) -> list[dict]:
     """
-    1つの画像+マスクペアから3Dモデルを生成
+    1つの画像と複数マスクから3Dモデルを生成
+    
+    同じ元画像を共有するマスクは1回のリクエストにまとめ、
+    画像の読み込み・アップロードを1回で済ませる。
+    画像は Base64 + JSON ではなく msgpack で生の bytes のまま送信する。
+    ファイル読み込みは別スレッドで行い、
+    イベントループ（他グループの通信）をブロックしない
     """
-    print(f"  Processing: {name}")
+    names = [name for _, name in masks]
+    for name in names:
+        print(f"  Processing: {name}")
+    
+    def failure(name: str, error: str) -> dict:
+        return {
+            "name": name,
+            "success": False,
+            "error": error,
+        }
     
     try:
-        # 画像をBase64エンコード
-        image_b64 = load_image_as_base64(image_path)
-        mask_b64 = load_image_as_base64(mask_path)
+        # 画像を読み込み（グループごとに1回）
+        image_data, *mask_datas = await asyncio.gather(
+            asyncio.to_thread(load_image_bytes, image_path, max_side),
+            *[
+                asyncio.to_thread(load_image_bytes, mask_path, max_side, True)
+                for mask_path, _ in masks
+            ],
+        )
         
-        # サーバーにリクエスト
+        body = msgpack.packb({
+            "image": image_data,
+            "masks": [
+                {"mask": mask_data, "name": name}
+                for mask_data, name in zip(mask_datas, names)
+            ],
+            "seed": seed,
+            "output_format": output_format,
+        })
+        
+        # サーバーにリクエスト（マスク1枚あたり5分のタイムアウト）
         start_time = time.time()
-        response = requests.post(
-            f"{server_url}/generate",
-            json={
-                "image": image_b64,
-                "mask": mask_b64,
-                "seed": seed,
-                "output_format": output_format,
-            },
-            timeout=300,  # 5分タイムアウト
+        response = await client.post(
+            f"{server_url}/generate_multi",
+            content=body,
+            # レスポンスも msgpack で受け取り、モデルデータの Base64 エンコード・デコードを省く
+            headers={"content-type": "application/msgpack", "accept": "application/msgpack"},
+            timeout=300 * len(masks),
         )
         elapsed = time.time() - start_time
         
         if response.status_code != 200:
-            return {
-                "name": name,
-                "success": False,
-                "error": f"HTTP {response.status_code}: {response.text[:200]}",
-            }
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            return [failure(name, error) for name in names]
         
-        result = response.json()
+        if response.headers.get("content-type", "").startswith("application/msgpack"):
+            payload = msgpack.unpackb(response.content, raw=False)
+        else:
+            payload = response.json()
         
-        if not result.get("success"):
-            return {
+        results = []
+        for item in payload["results"]:
+            name = item["name"]
+            
+            if not item.get("success"):
+                results.append(failure(name, item.get("message") or "Unknown error"))
+                continue
+            
+            # モデルを保存
+            output_path = output_dir / f"{name}.{item['format']}"
+            await asyncio.to_thread(save_model_data, item["model_data"], output_path)
+            
+            # ファイルサイズを取得
+            file_size = output_path.stat().st_size / (1024 * 1024)  # MB
+            
+            results.append({
                 "name": name,
-                "success": False,
-                "error": result.get("error", "Unknown error"),
-            }
+                "success": True,
+                "output_path": str(output_path),
+                "file_size_mb": round(file_size, 2),
+                "elapsed_seconds": round(elapsed, 1),
+            })
         
-        # モデルを保存
-        output_path = output_dir / f"{name}.{output_format}"
-        save_model_from_base64(result["model_data"], output_path)
+        return results
         
-        # ファイルサイズを取得
-        file_size = output_path.stat().st_size / (1024 * 1024)  # MB
-        
-        return {
-            "name": name,
-            "success": True,
-            "output_path": str(output_path),
-            "file_size_mb": round(file_size, 2),
-            "elapsed_seconds": round(elapsed, 1),
-        }
-        
-    except requests.exceptions.Timeout:
-        return {
-            "name": name,
-            "success": False,
-            "error": "Request timeout (5 min)",
-        }
+    except httpx.TimeoutException:
+        return [failure(name, f"Request timeout ({5 * len(masks)} min)") for name in names]
     except Exception as e:
-        return {
-            "name": name,
-            "success": False,
-            "error": str(e),
-        }
+        return [failure(name, str(e)) for name in names]
 
 
-def check_server_health(server_url: str) -> bool:
+async def check_server_health(client: httpx.AsyncClient, server_url: str) -> bool:
     """サーバーの健全性をチェック"""
     try:
-        response = requests.get(f"{server_url}/health", timeout=120)
+        response = await client.get(f"{server_url}/health", timeout=120)
         if response.status_code == 200:
             data = response.json()
             print(f"✓ Server OK: {data.get('gpu', 'Unknown GPU')}")
@@ -191,6 +263,61 @@ def check_server_health(server_url: str) -> bool:
         return False
 
 
+async def run_generation(
+    pairs: list[tuple[Path, Path, str]],
+    output_dir: Path,
+    server_url: str,
+    output_format: str,
+    seed: int,
+    parallel: int,
+    max_side: int = 0,
+) -> list[dict]:
+    """
+    サーバーのヘルスチェック後、全ペアの生成リクエストを非同期に実行
+    
+    同じ元画像を持つペアは1リクエストにまとめる。
+    ヘルスチェックを含む全リクエストで1つのHTTP/2コネクションプールを共有するため、
+    DNS解決とTLSハンドシェイクは一度だけで済み、リクエストは多重化される
+    """
+    # 元画像ごとにマスクをグループ化
+    groups: dict[Path, list[tuple[Path, str]]] = defaultdict(list)
+    for img, mask, name in pairs:
+        groups[img].append((mask, name))
+    
+    semaphore = asyncio.Semaphore(parallel)
+    limits = httpx.Limits(max_connections=parallel)
+    
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=300,  # 5分タイムアウト
+        limits=limits,
+    ) as client:
+        # サーバー確認
+        print("Checking server health...")
+        if not await check_server_health(client, server_url):
+            print("\nServer is not available. Please ensure the Modal server is running.")
+            print("Run: modal deploy backend/sam3d_modal.py")
+            sys.exit(1)
+        print()
+        
+        # 生成実行
+        print("Starting generation...")
+        
+        async def worker(img: Path, masks: list[tuple[Path, str]]) -> list[dict]:
+            # 同時実行数を --parallel で制限
+            async with semaphore:
+                return await generate_3d(
+                    client, img, masks, output_dir,
+                    server_url, output_format, seed, max_side
+                )
+        
+        group_results = await asyncio.gather(
+            *[worker(img, masks) for img, masks in groups.items()]
+        )
+    
+    return [result for results in group_results for result in results]
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Batch generate 3D models from images and masks using Modal SAM3D server"
@@ -232,6 +359,12 @@ def main():
         default=1,
         help="Number of parallel requests (default: 1, Modal may limit concurrency)",
     )
+    parser.add_argument(
+        "--max-side",
+        type=int,
+        default=1024,
+        help="Downscale images whose longer side exceeds this before upload (default: 1024, 0 to disable)",
+    )
     
     args = parser.parse_args()
     
@@ -255,14 +388,6 @@ def main():
     print(f"Format: {args.format}")
     print()
     
-    # サーバー確認
-    print("Checking server health...")
-    if not check_server_health(args.server):
-        print("\nServer is not available. Please ensure the Modal server is running.")
-        print("Run: modal deploy backend/sam3d_modal.py")
-        sys.exit(1)
-    print()
-    
     # 画像+マスクのペアを探す
     pairs = find_image_mask_pairs(input_dir)
     
@@ -278,31 +403,10 @@ def main():
         print(f"  - {name}: {img.name} + {mask.name}")
     print()
     
-    # 生成実行
-    print("Starting generation...")
-    results = []
-    
-    if args.parallel > 1:
-        # 並列処理
-        with ThreadPoolExecutor(max_workers=args.parallel) as executor:
-            futures = {
-                executor.submit(
-                    generate_3d, img, mask, name, output_dir, 
-                    args.server, args.format, args.seed
-                ): name
-                for img, mask, name in pairs
-            }
-            for future in as_completed(futures):
-                result = future.result()
-                results.append(result)
-    else:
-        # 順次処理
-        for img, mask, name in pairs:
-            result = generate_3d(
-                img, mask, name, output_dir,
-                args.server, args.format, args.seed
-            )
-            results.append(result)
+    results = asyncio.run(run_generation(
+        pairs, output_dir, args.server, args.format, args.seed, args.parallel,
+        args.max_side,
+    ))
     
     # 結果サマリー
     print(f"\n{'='*60}")
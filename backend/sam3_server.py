@@ -15,22 +15,90 @@ SAM3 Segmentation Server (Local)
 import os
 import sys
 import io
-import base64
+import asyncio
+import hashlib
 import logging
-from typing import Optional
-from contextlib import asynccontextmanager
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+from contextlib import asynccontextmanager, contextmanager
 
 import numpy as np
 from PIL import Image
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+# pybase64 (SIMD 対応) があれば標準の base64 の代わりに使う
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# xxhash (SIMD 対応の非暗号学的ハッシュ) があればキャッシュキーの計算に使う
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# PyTurboJPEG (libjpeg-turbo) があれば JPEG のデコードに使う
+# （ライブラリ本体が見つからない場合も Pillow にフォールバック）
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
 
 # SAM3 パスを追加
 SAM3_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "sam3"))
 if SAM3_PATH not in sys.path:
     sys.path.insert(0, SAM3_PATH)
 
+# torch / sam3 は常に必要なためモジュール読み込み時に import する
+# （未インストールの場合はフォールバックモードで起動）
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# GPU 推論時は CPU 側の演算スレッドを1本に絞る
+# （OpenMP がコア数分のスレッドを生成し、リクエスト処理と CPU を奪い合うのを防ぐ）
+# CPU 推論時はマルチスレッドが必要なため変更しない
+if torch is not None and torch.cuda.is_available():
+    torch.set_num_threads(1)
+    torch.set_num_interop_threads(1)
+
+try:
+    import sam3
+except ImportError:
+    sam3 = None
+
+# SAM1（SAM3 が使えない場合のフォールバック）
+try:
+    from segment_anything import SamPredictor, sam_model_registry
+except ImportError:
+    SamPredictor = None
+    sam_model_registry = None
+
+BPE_FILENAME = "bpe_simple_vocab_16e6.txt.gz"
+
+
+def _resolve_bpe_path() -> Optional[str]:
+    """SAM3 の BPE トークナイザファイルのパスを解決"""
+    if sam3 is None:
+        return None
+    bpe_path = os.path.join(os.path.dirname(sam3.__file__), "..", "assets", BPE_FILENAME)
+    if os.path.exists(bpe_path):
+        return bpe_path
+    return os.path.join(SAM3_PATH, "assets", BPE_FILENAME)
+
+
+# パス解決はインポート時に1回だけ行う
+_BPE_PATH = _resolve_bpe_path()
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,7 +110,48 @@ _model = None
 _processor = None
 _current_image_state = None
 _current_image_hash = None
+_current_image_size = None  # [width, height]
 _sam3_available = False  # SAM3が利用可能かどうか
+_autocast_dtype = None  # 推論時の autocast の型（None なら autocast しない）
+_is_sam1 = False  # ロード済みのモデルが SAM1 (SamPredictor) かどうか（リクエストごとの isinstance を避ける）
+# SAM1 のポイント入力用に事前確保したバッファ（pinned メモリと GPU、CUDA 時のみ）
+# リクエストごとの GPU メモリ確保と同期転送を避け、スライスして使い回す
+_point_buffers: Optional[dict] = None
+# モデルのロード・推論を実行する専用スレッド
+# イベントループをブロックせず、モデルと現在の画像状態へのアクセスも直列化される。
+# torch.compile の CUDA Graph はスレッドごとに記録されるため、常に同じスレッドで実行する
+_model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam-model")
+# マスクの PNG エンコード用スレッド（zlib 圧縮中は GIL が解放されるため並列化が効く）
+_mask_encode_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="mask-encode")
+
+# 画像エンコーダを torch.compile するかどうか（CUDA のみ）
+COMPILE_ENABLED = os.environ.get("SAM3_COMPILE", "1") == "1"
+# ウォームアップ用ダミー画像のサイズ（SAM の入力解像度）
+WARMUP_IMAGE_SIZE = 1024
+
+# 画像エンベディングの LRU キャッシュ（キー: 画像ハッシュ）
+# 複数画像を切り替えながらポイント指定しても、エンコーダを再実行しない
+FEATURE_CACHE_SIZE = int(os.environ.get("SAM3_FEATURE_CACHE_SIZE", "8"))
+_feature_cache: OrderedDict = OrderedDict()
+
+# フォールバックモード用のデコード済み画像の LRU キャッシュ（キー: 画像ハッシュ）
+# エンベディングキャッシュが使えないため、同じ画像へのクリックごとのデコードをここで省く
+DECODE_CACHE_SIZE = int(os.environ.get("SAM3_DECODE_CACHE_SIZE", "4"))
+_decode_cache: OrderedDict = OrderedDict()
+_decode_cache_lock = threading.Lock()  # スレッドプールから並行して呼ばれるため
+
+# /segment の推論結果の LRU キャッシュ（キー: 画像ハッシュ + 整数化したポイント + multimask_output）
+# 同じ位置の再クリックやリトライでは GPU 推論を丸ごと省く
+RESULT_CACHE_SIZE = int(os.environ.get("SAM3_RESULT_CACHE_SIZE", "16"))
+_result_cache: OrderedDict = OrderedDict()
+
+# /segment のマイクロバッチ設定
+# 同じ画像へのリクエストを短い時間窓でまとめ、1回の推論で処理する（1 以下で無効）
+SEGMENT_BATCH_SIZE = int(os.environ.get("SAM3_BATCH_SIZE", "8"))
+SEGMENT_BATCH_WINDOW_MS = float(os.environ.get("SAM3_BATCH_WINDOW_MS", "5"))
+# 事前確保するポイントバッファの1リクエストあたりの最大ポイント数（超えた場合は都度確保）
+MAX_SEGMENT_POINTS = 64
+_segment_queue: Optional[asyncio.Queue] = None
 
 
 # ========================================
@@ -52,16 +161,24 @@ _sam3_available = False  # SAM3が利用可能かどうか
 class SegmentationRequest(BaseModel):
     """セグメンテーションリクエスト"""
     image: str  # Base64エンコードされた画像
-    points_positive: list[list[float]]  # [[x1, y1], [x2, y2], ...] 正例ポイント
-    points_negative: list[list[float]] = []  # [[x1, y1], ...] 負例ポイント
+    # 各ポイントは (x, y) の2要素に限定する。不正な形状はキュー投入前に 422 で弾き、
+    # 同じバッチにまとめられた他のリクエストを巻き込まないようにする
+    points_positive: list[tuple[float, float]]  # [[x1, y1], [x2, y2], ...] 正例ポイント
+    points_negative: list[tuple[float, float]] = []  # [[x1, y1], ...] 負例ポイント
     multimask_output: bool = False  # 複数マスク出力（True: 3マスク, False: 1マスク）
+    # マスクの返却形式（"png": PNG画像, "packbits": np.packbits した1ピクセル1ビットの配列,
+    # "packbits_zlib": packbits をさらに zlib 圧縮したもの）
+    mask_format: Literal["png", "packbits", "packbits_zlib"] = "png"
+    # /set_image が返した画像ハッシュ。サーバーにキャッシュ済みならハッシュ計算を省略する
+    image_hash: Optional[str] = None
 
 
 class SegmentationResponse(BaseModel):
     """セグメンテーションレスポンス"""
     success: bool
-    masks: list[str] = []  # Base64エンコードされたマスク画像リスト
+    masks: list[str] = []  # Base64エンコードされたマスク（mask_format に従う）
     scores: list[float] = []  # 各マスクのスコア
+    mask_shape: list[int] = []  # packbits / packbits_zlib 形式の場合のマスク形状 [height, width]
     message: str = ""
 
 
@@ -74,6 +191,7 @@ class SetImageResponse(BaseModel):
     """画像設定レスポンス"""
     success: bool
     image_size: list[int] = []  # [width, height]
+    image_hash: str = ""  # 以降の /segment で image_hash として送れる画像ハッシュ（hex）
     message: str = ""
 
 
@@ -92,7 +210,8 @@ class HealthResponse(BaseModel):
 
 def get_device():
     """利用可能なデバイスを取得"""
-    import torch
+    if torch is None:
+        return "cpu"
     if torch.cuda.is_available():
         return "cuda"
     elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
@@ -101,9 +220,92 @@ def get_device():
         return "cpu"
 
 
+@contextmanager
+def inference_context():
+    """推論用コンテキスト（勾配無効化 + 必要に応じて混合精度 autocast）"""
+    with torch.inference_mode():
+        if _autocast_dtype is not None:
+            with torch.autocast("cuda", dtype=_autocast_dtype):
+                yield
+        else:
+            yield
+
+
+def warmup_model():
+    """ダミー画像でエンコーダを1回実行し、コンパイル・カーネル選択を済ませる"""
+    dummy = Image.new("RGB", (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE))
+    
+    with inference_context():
+        if _is_sam1:
+            _processor.set_image(np.asarray(dummy))
+            _processor.reset_image()
+        else:
+            _processor.set_image(dummy)
+
+
+def compile_image_encoder(model, attr: str, method: Optional[str] = None) -> None:
+    """
+    画像エンコーダを torch.compile してウォームアップ
+    
+    method を指定した場合はモジュールの forward ではなく、プロセッサが実際に
+    呼び出すそのメソッド（例: backbone.forward_image）をコンパイルする。
+    モジュール自体を差し替えても、メソッド呼び出しはコンパイル済みの forward を通らないため
+    
+    コンパイルは最初の呼び出しで行われるため、起動時のウォームアップで
+    失敗した場合（Triton 非対応環境など）は元の実装に戻す
+    
+    CUDA Graphs を使う reduce-overhead モードは出力を静的バッファに書くため、
+    次の画像のエンコードでエンベディングキャッシュ内の特徴量が上書きされる。
+    キャッシュを正しく保つため CUDA Graphs なしのモードでコンパイルする
+    """
+    encoder = getattr(model, attr, None)
+    if encoder is None:
+        logger.warning(f"Image encoder '{attr}' not found, skipping torch.compile")
+        return
+    if method is not None and not callable(getattr(encoder, method, None)):
+        logger.warning(f"Image encoder method '{attr}.{method}' not found, skipping torch.compile")
+        return
+    
+    target = attr if method is None else f"{attr}.{method}"
+    logger.info(f"Compiling {target} with torch.compile (max-autotune-no-cudagraphs)...")
+    if method is None:
+        setattr(
+            model, attr,
+            torch.compile(encoder, mode="max-autotune-no-cudagraphs", fullgraph=False),
+        )
+    else:
+        # インスタンス属性としてクラスのメソッドを上書きする
+        setattr(
+            encoder, method,
+            torch.compile(getattr(encoder, method), mode="max-autotune-no-cudagraphs", fullgraph=False),
+        )
+    try:
+        warmup_model()
+        logger.info(f"{target} compiled and warmed up")
+    except Exception as e:
+        logger.warning(f"torch.compile failed, using eager mode: {e}")
+        if method is None:
+            setattr(model, attr, encoder)
+        else:
+            delattr(encoder, method)
+        # eager でも失敗する場合は呼び出し元（load_model）でモデルの読み込み失敗として扱う
+        warmup_model()
+
+
+def reset_model_state() -> None:
+    """読み込みに失敗したモデルを参照しないよう、モデル関連のグローバル状態を初期化"""
+    global _model, _processor, _sam3_available, _autocast_dtype, _is_sam1, _point_buffers
+    _model = None
+    _processor = None
+    _sam3_available = False
+    _autocast_dtype = None
+    _is_sam1 = False
+    _point_buffers = None
+
+
 def load_model():
     """SAMモデルをロード（SAM3 → SAM1 フォールバック）"""
-    global _model, _processor, _sam3_available
+    global _model, _processor, _sam3_available, _autocast_dtype, _is_sam1, _point_buffers
     
     if _model is not None:
         logger.info("Model already loaded")
@@ -113,40 +315,44 @@ def load_model():
     
     # まずSAM3を試行
     try:
-        import torch
+        if torch is None or sam3 is None:
+            raise ImportError("torch or sam3 is not installed")
         from sam3 import build_sam3_image_model
         from sam3.model.sam3_image_processor import Sam3Processor
-        import sam3
         
         logger.info(f"Loading SAM3 model on device: {device}")
         
         if device == "cuda":
             torch.backends.cuda.matmul.allow_tf32 = True
             torch.backends.cudnn.allow_tf32 = True
-            torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
+            # autocast はグローバルに入らず、推論呼び出しごとに inference_context() で適用
+            _autocast_dtype = torch.bfloat16
         
-        sam3_root = os.path.dirname(sam3.__file__)
-        bpe_path = os.path.join(sam3_root, "..", "assets", "bpe_simple_vocab_16e6.txt.gz")
-        
-        if not os.path.exists(bpe_path):
-            bpe_path = os.path.join(SAM3_PATH, "assets", "bpe_simple_vocab_16e6.txt.gz")
-        
-        _model = build_sam3_image_model(bpe_path=bpe_path, enable_inst_interactivity=True)
+        _model = build_sam3_image_model(bpe_path=_BPE_PATH, enable_inst_interactivity=True)
+        if device == "cuda":
+            _model = _model.to(memory_format=torch.channels_last)
         _processor = Sam3Processor(_model)
         _sam3_available = True
         
+        if device == "cuda" and COMPILE_ENABLED:
+            # Sam3Processor.set_image() は model.backbone.forward_image() を呼ぶため、
+            # モジュールの forward ではなくこのメソッドをコンパイルする
+            compile_image_encoder(_model, "backbone", "forward_image")
+        
         logger.info("SAM3 model loaded successfully!")
         return True
         
     except ImportError as ie:
         logger.warning(f"SAM3 not available: {ie}")
+        reset_model_state()
     except Exception as e:
         logger.warning(f"SAM3 failed to load: {e}")
+        reset_model_state()
     
     # SAM3が使えない場合、SAM1（オリジナル）を試行
     try:
-        import torch
-        from segment_anything import sam_model_registry, SamPredictor
+        if SamPredictor is None:
+            raise ImportError("No module named 'segment_anything'")
         
         logger.info(f"Loading SAM1 model on device: {device}")
         
@@ -162,20 +368,43 @@ def load_model():
         
         sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
         sam.to(device=device)
+        if device == "cuda":
+            sam.to(memory_format=torch.channels_last)
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            # SamPredictor.predict() は出力を .numpy() に変換するため、numpy が扱えない
+            # bfloat16 ではなく float16 で autocast する（マスクは二値化されるので精度は問題にならない）
+            _autocast_dtype = torch.float16
+            
+            batch_size = max(SEGMENT_BATCH_SIZE, 1)
+            # 1次元で確保し、使う分だけ先頭から view して常に連続したテンソルにする
+            # （(B, N) 形状から [:b, :n] でスライスすると非連続になり、コピーが一時バッファを経由する）
+            capacity = batch_size * MAX_SEGMENT_POINTS
+            _point_buffers = {
+                "capacity": capacity,
+                "coords_host": torch.empty(capacity * 2, dtype=torch.float, pin_memory=True),
+                "labels_host": torch.empty(capacity, dtype=torch.int, pin_memory=True),
+                "coords_device": torch.empty(capacity * 2, dtype=torch.float, device=device),
+                "labels_device": torch.empty(capacity, dtype=torch.int, device=device),
+            }
         
         _model = sam
         _processor = SamPredictor(sam)
+        _is_sam1 = True
         _sam3_available = True
         
+        if device == "cuda" and COMPILE_ENABLED:
+            compile_image_encoder(_model, "image_encoder")
+        
         logger.info("SAM1 model loaded successfully!")
         return True
         
     except ImportError as ie:
         logger.warning(f"SAM1 not available: {ie}")
+        reset_model_state()
     except Exception as e:
-        logger.error(f"SAM1 failed to load: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"SAM1 failed to load: {e}")
+        reset_model_state()
     
     logger.info("Running in fallback mode (no segmentation)")
     _sam3_available = False
@@ -189,36 +418,176 @@ def decode_base64_image(base64_str: str) -> Image.Image:
         base64_str = base64_str.split(",")[1]
     
     image_bytes = base64.b64decode(base64_str)
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    
+    # JPEG は libjpeg-turbo で直接 RGB の配列にデコード（Pillow のデコーダを経由しない）
+    if _turbojpeg is not None and image_bytes[:2] == b"\xff\xd8":
+        return Image.fromarray(_turbojpeg.decode(image_bytes, pixel_format=TJPF_RGB))
+    
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG の場合はデコーダに出力モードを伝え、デコード時に変換させる
+    image.draft("RGB", None)
+    image.load()
+    # 既に RGB なら変換（全画素のコピー）を省略
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def decode_base64_image_cached(base64_str: str) -> Image.Image:
+    """decode_base64_image() の結果を Base64 文字列のハッシュをキーにキャッシュ"""
+    image_hash = get_image_hash(base64_str)
+    with _decode_cache_lock:
+        image = _decode_cache.get(image_hash)
+        if image is not None:
+            _decode_cache.move_to_end(image_hash)
+            return image
+    
+    image = decode_base64_image(base64_str)
+    with _decode_cache_lock:
+        _decode_cache[image_hash] = image
+        while len(_decode_cache) > DECODE_CACHE_SIZE:
+            _decode_cache.popitem(last=False)
     return image
 
 
 def encode_mask_to_base64(mask: np.ndarray) -> str:
     """マスク配列をBase64エンコードされたPNG画像に変換"""
-    # マスクを0-255のuint8に変換
+    # マスクを0-255のuint8に変換（中間配列を作らず、出力バッファ1つで処理）
     if mask.dtype == bool:
-        mask_uint8 = (mask * 255).astype(np.uint8)
+        # bool -> uint8 はビットの再解釈のみ（コピーなし）
+        mask_uint8 = mask.view(np.uint8) * np.uint8(255)
     else:
-        mask_uint8 = (mask > 0.5).astype(np.uint8) * 255
+        mask_uint8 = np.empty(mask.shape, dtype=np.uint8)
+        np.greater(mask, 0.5, out=mask_uint8.view(bool))
+        mask_uint8 *= 255
     
     # PIL Imageに変換
     mask_image = Image.fromarray(mask_uint8, mode="L")
     
     # PNGとしてエンコード
+    # 2値マスクは低い圧縮レベルでも十分小さくなるため、zlib の計算量を抑える
     buffer = io.BytesIO()
-    mask_image.save(buffer, format="PNG")
-    buffer.seek(0)
+    mask_image.save(buffer, format="PNG", optimize=False, compress_level=1)
     
-    return base64.b64encode(buffer.read()).decode("utf-8")
+    # getbuffer() は getvalue() と違い内部バッファをコピーしない
+    return base64.b64encode(buffer.getbuffer()).decode("utf-8")
 
 
-def get_image_hash(image: Image.Image) -> str:
-    """画像のハッシュを計算（キャッシュ用）"""
-    import hashlib
-    # 画像をバイト列に変換してハッシュ
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    return hashlib.md5(buffer.getvalue()).hexdigest()
+def encode_mask_packbits(mask: np.ndarray, compress: bool = False) -> str:
+    """
+    マスク配列を1ピクセル1ビットにパックしてBase64エンコード（PNGエンコードなし）
+    
+    クライアント側では np.unpackbits(data, count=h * w).reshape(h, w) で復元できる。
+    compress=True の場合はパック後に zlib（レベル1）で圧縮する。
+    物体マスクは同じ値が長く続くため、PNG のフィルタ処理なしでも数 KB 程度まで縮む
+    （ブラウザでは DecompressionStream("deflate") で展開できる）
+    """
+    if mask.dtype != bool:
+        mask = mask > 0.5
+    packed = np.packbits(mask, axis=None)
+    if compress:
+        return base64.b64encode(zlib.compress(packed, 1)).decode("utf-8")
+    return base64.b64encode(packed).decode("utf-8")
+
+
+def encode_masks(masks, mask_format: str) -> tuple[list[str], list[int]]:
+    """
+    マスクのリストを指定形式でエンコード
+    
+    Returns:
+        (エンコード済みマスクのリスト, packbits / packbits_zlib 形式の場合のマスク形状 [height, width])
+    """
+    if mask_format in ("packbits", "packbits_zlib"):
+        compress = mask_format == "packbits_zlib"
+        encoded = [encode_mask_packbits(mask, compress) for mask in masks]
+        shape = list(masks[0].shape[-2:]) if len(masks) > 0 else []
+        return encoded, shape
+    if len(masks) > 1:
+        # multimask_output=True の 3 枚などは PNG エンコードをスレッドで並列実行
+        return list(_mask_encode_executor.map(encode_mask_to_base64, masks)), []
+    return [encode_mask_to_base64(mask) for mask in masks], []
+
+
+def get_image_hash(image_b64: str) -> bytes:
+    """
+    画像のハッシュを Base64 文字列のまま計算（キャッシュ用）
+    
+    デコード前に計算できるため、キャッシュヒット時は Base64 / 画像のデコードを丸ごと省略できる。
+    キャッシュキーなので暗号学的強度は不要。xxh3 が無ければ SHA-256 を使う。
+    hex 文字列化のコストを避けるため digest (bytes) をそのままキーにする
+    """
+    if xxhash is not None:
+        # xxhash は str をそのまま受け取れるため、数 MB の bytes コピーを作らない
+        return xxhash.xxh3_128_digest(image_b64)
+    return hashlib.sha256(image_b64.encode()).digest()
+
+
+def activate_image(image_b64: str, image_hash: bytes) -> tuple[bool, list[int]]:
+    """
+    画像をセグメンテーション対象として設定（エンベディングは LRU キャッシュを利用）
+    
+    キャッシュヒット時は画像をデコードしない。
+    
+    Returns:
+        (キャッシュヒットした場合 True（エンコーダを実行していない）, 画像サイズ [width, height])
+    """
+    global _current_image_state, _current_image_hash, _current_image_size
+    
+    # 現在設定中の画像と同じ
+    if _current_image_hash == image_hash:
+        return True, _current_image_size
+    
+    # キャッシュヒット: 保存済みのエンベディングを復元
+    cached = _feature_cache.get(image_hash)
+    if cached is not None:
+        _feature_cache.move_to_end(image_hash)
+        state = cached["state"]
+        if _is_sam1:
+            # SAM1: SamPredictor の内部状態を復元
+            _processor.reset_image()
+            _processor.features = state["features"]
+            _processor.original_size = state["original_size"]
+            _processor.input_size = state["input_size"]
+            _processor.is_image_set = True
+            _current_image_state = True  # フラグとして使用
+        else:
+            _current_image_state = state
+        _current_image_hash = image_hash
+        _current_image_size = cached["image_size"]
+        return True, _current_image_size
+    
+    # キャッシュミス: 画像をデコードしてエンベディングを計算
+    image = decode_base64_image(image_b64)
+    logger.info(f"Computing embeddings for image: {image.width}x{image.height}")
+    with inference_context():
+        if _is_sam1:
+            # SAM1: set_image() は numpy array を受け取る
+            # predictor 側は入力を読むだけなので np.asarray で渡す。PIL の画素は tobytes() 経由で
+            # 1回コピーされる（読み取り専用配列になる）が、np.array のような2回目のコピーはしない
+            _processor.set_image(np.asarray(image))
+            _current_image_state = True  # フラグとして使用
+            state = {
+                "features": _processor.features,
+                "original_size": _processor.original_size,
+                "input_size": _processor.input_size,
+            }
+        else:
+            # SAM3
+            _current_image_state = _processor.set_image(image)
+            state = _current_image_state
+    
+    _current_image_hash = image_hash
+    _current_image_size = [image.width, image.height]
+    _feature_cache[image_hash] = {"state": state, "image_size": _current_image_size}
+    while len(_feature_cache) > FEATURE_CACHE_SIZE:
+        _feature_cache.popitem(last=False)
+    return False, _current_image_size
+
+
+async def run_on_model_thread(func, *args):
+    """モデル専用スレッドで関数を実行し、結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_model_executor, func, *args)
 
 
 # ========================================
@@ -230,10 +599,18 @@ async def lifespan(app: FastAPI):
     """アプリケーションのライフサイクル管理"""
     # 起動時：モデルをロード
     logger.info("Starting SAM3 Segmentation Server...")
-    load_model()
+    await run_on_model_thread(load_model)
+    
+    global _segment_queue
+    batch_task = None
+    if SEGMENT_BATCH_SIZE > 1:
+        _segment_queue = asyncio.Queue()
+        batch_task = asyncio.create_task(segment_batch_worker())
     yield
     # シャットダウン時
     logger.info("Shutting down SAM3 Segmentation Server...")
+    if batch_task is not None:
+        batch_task.cancel()
 
 
 app = FastAPI(
@@ -269,6 +646,35 @@ async def health():
     )
 
 
+def run_set_image(request: SetImageRequest) -> SetImageResponse:
+    """画像エンベディングを計算してキャッシュ（ワーカースレッドで実行）"""
+    try:
+        # デコード前に Base64 文字列のハッシュを計算
+        image_hash = get_image_hash(request.image)
+        
+        # 既にキャッシュ済みの場合はデコードとエンベディング計算をスキップ
+        cached, image_size = activate_image(request.image, image_hash)
+        if cached:
+            logger.info("Image already cached, skipping embedding computation")
+            return SetImageResponse(
+                success=True,
+                image_size=image_size,
+                image_hash=image_hash.hex(),
+                message="Image already cached",
+            )
+        
+        return SetImageResponse(
+            success=True,
+            image_size=image_size,
+            image_hash=image_hash.hex(),
+            message="Image embeddings computed successfully",
+        )
+        
+    except Exception as e:
+        logger.exception(f"Error setting image: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/set_image", response_model=SetImageResponse)
 async def set_image(request: SetImageRequest):
     """
@@ -278,12 +684,10 @@ async def set_image(request: SetImageRequest):
     同じ画像に対して複数回のセグメンテーションを行う場合、
     このAPIを先に呼んでおくと効率的です。
     """
-    global _current_image_state, _current_image_hash
-    
     # SAM3が利用できない場合はスキップ
     if not _sam3_available or _model is None or _processor is None:
         try:
-            image = decode_base64_image(request.image)
+            image = await run_in_threadpool(decode_base64_image_cached, request.image)
             return SetImageResponse(
                 success=True,
                 image_size=[image.width, image.height],
@@ -292,55 +696,238 @@ async def set_image(request: SetImageRequest):
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     
+    return await run_on_model_thread(run_set_image, request)
+
+
+def sort_masks_by_score(masks: np.ndarray, scores: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """マスクをスコア降順に並べ替える"""
+    # 逆順ビュー [::-1] ではなく -scores を安定ソートし、同点時も元の順序を保つ
+    sorted_indices = np.argsort(-scores, kind="stable")
+    return masks[sorted_indices], scores[sorted_indices]
+
+
+def predict_points(request: SegmentationRequest) -> tuple[np.ndarray, np.ndarray]:
+    """現在設定中の画像に対して1リクエスト分のポイント推論を行う"""
+    # ポイント座標を準備（Python リストの連結や np.array の型推論を避け、確保済み配列に直接書き込む）
+    num_positive = len(request.points_positive)
+    num_points = num_positive + len(request.points_negative)
+    point_coords = np.empty((num_points, 2), dtype=np.float32)
+    if num_positive:
+        point_coords[:num_positive] = request.points_positive
+    if request.points_negative:
+        point_coords[num_positive:] = request.points_negative
+    # サブピクセルの差はマスクに影響しないため整数座標に丸める（結果キャッシュのキーと揃える）
+    np.rint(point_coords, out=point_coords)
+    point_labels = np.empty(num_points, dtype=np.int32)
+    point_labels[:num_positive] = 1
+    point_labels[num_positive:] = 0
+    
+    logger.info(f"Segmenting with {len(request.points_positive)} positive, {len(request.points_negative)} negative points")
+    
+    # セグメンテーション実行（SAM3 API: predict_inst()）
+    # SAM1 は predict_points_batched() で predict_torch() を直接呼ぶ
+    with inference_context():
+        masks, scores, logits = _model.predict_inst(
+            _current_image_state,
+            point_coords=point_coords,
+            point_labels=point_labels,
+            multimask_output=request.multimask_output,
+        )
+    
+    return sort_masks_by_score(masks, scores)
+
+
+def stage_point_tensors(point_coords: np.ndarray, point_labels: np.ndarray):
+    """
+    ポイント座標・ラベルを推論デバイスのテンソルに転送
+    
+    事前確保したバッファに収まる場合は pinned メモリ経由で非同期転送し、GPU 側の確保も省く。
+    バッファはモデルスレッドからのみ使い、結果の .cpu() で同期されるため次のリクエストと競合しない
+    """
+    batch_size, num_points = point_labels.shape
+    size = batch_size * num_points
+    if _point_buffers is None or size > _point_buffers["capacity"]:
+        return (
+            torch.as_tensor(point_coords, dtype=torch.float, device=_processor.device),
+            torch.as_tensor(point_labels, dtype=torch.int, device=_processor.device),
+        )
+    
+    coords_host = _point_buffers["coords_host"][:size * 2].view(batch_size, num_points, 2)
+    labels_host = _point_buffers["labels_host"][:size].view(batch_size, num_points)
+    coords_host.copy_(torch.from_numpy(point_coords))
+    labels_host.copy_(torch.from_numpy(point_labels))
+    
+    coords_device = _point_buffers["coords_device"][:size * 2].view(batch_size, num_points, 2)
+    labels_device = _point_buffers["labels_device"][:size].view(batch_size, num_points)
+    coords_device.copy_(coords_host, non_blocking=True)
+    labels_device.copy_(labels_host, non_blocking=True)
+    return coords_device, labels_device
+
+
+def predict_points_batched(requests: list[SegmentationRequest]) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    SAM1: 同じ画像へのリクエスト群（1件でも可）を predict_torch の1回の呼び出しでまとめて推論
+    
+    ポイント数の異なるリクエストはラベル -1（SAM のパディング用ラベル）で最長に揃える。
+    predict() の numpy 経由の変換を通さず、ポイントを直接テンソルとして渡す
+    """
+    num_points = [len(r.points_positive) + len(r.points_negative) for r in requests]
+    max_points = max(num_points)
+    
+    point_coords = np.zeros((len(requests), max_points, 2), dtype=np.float32)
+    point_labels = np.full((len(requests), max_points), -1, dtype=np.int32)
+    for i, r in enumerate(requests):
+        num_positive = len(r.points_positive)
+        if num_positive:
+            point_coords[i, :num_positive] = r.points_positive
+        if r.points_negative:
+            point_coords[i, num_positive:num_points[i]] = r.points_negative
+        point_labels[i, :num_positive] = 1
+        point_labels[i, num_positive:num_points[i]] = 0
+    # サブピクセルの差はマスクに影響しないため整数座標に丸める（結果キャッシュのキーと揃える）
+    np.rint(point_coords, out=point_coords)
+    
+    logger.info(f"Segmenting batch of {len(requests)} request(s), up to {max_points} points each")
+    
+    # predict() と同じく、座標を入力解像度に変換してから渡す
+    point_coords = _processor.transform.apply_coords(point_coords, _processor.original_size)
+    coords_torch, labels_torch = stage_point_tensors(point_coords, point_labels)
+    
+    with inference_context():
+        masks, scores, logits = _processor.predict_torch(
+            coords_torch,
+            labels_torch,
+            multimask_output=requests[0].multimask_output,
+        )
+    
+    masks_np = masks.cpu().numpy()
+    scores_np = scores.float().cpu().numpy()
+    return [sort_masks_by_score(masks_np[i], scores_np[i]) for i in range(len(requests))]
+
+
+def run_segmentation_batch(
+    requests: list[SegmentationRequest], image_hash: bytes
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    同じ画像・同じ multimask_output のリクエスト群に対してセグメンテーションを実行（ワーカースレッドで実行）
+    
+    Returns:
+        リクエストごとの (スコア降順のマスク配列, スコア配列)
+    """
     try:
-        # 画像デコード
-        image = decode_base64_image(request.image)
-        image_hash = get_image_hash(image)
+        # 画像が変更された場合のみデコードしてエンベディングを再計算（キャッシュにあれば復元）
+        activate_image(requests[0].image, image_hash)
         
-        # 既にキャッシュ済みの場合はスキップ
-        if _current_image_hash == image_hash:
-            logger.info("Image already cached, skipping embedding computation")
-            return SetImageResponse(
-                success=True,
-                image_size=[image.width, image.height],
-                message="Image already cached",
-            )
-        
-        # 画像エンベディングを計算
-        logger.info(f"Computing embeddings for image: {image.width}x{image.height}")
-        
-        # SAM1 (SamPredictor) の場合
-        from segment_anything import SamPredictor
-        if isinstance(_processor, SamPredictor):
-            # SAM1: set_image() は numpy array を受け取る
-            image_np = np.array(image)
-            _processor.set_image(image_np)
-            _current_image_state = True  # フラグとして使用
-        else:
-            # SAM3
-            _current_image_state = _processor.set_image(image)
-        
-        _current_image_hash = image_hash
-        
-        return SetImageResponse(
-            success=True,
-            image_size=[image.width, image.height],
-            message="Image embeddings computed successfully",
-        )
+        if _is_sam1:
+            return predict_points_batched(requests)
+        # SAM3 の predict_inst はバッチ入力に対応していないため1件ずつ推論
+        return [predict_points(r) for r in requests]
         
     except Exception as e:
-        logger.error(f"Error setting image: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error during segmentation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def segment_batch_worker():
+    """
+    /segment のリクエストをキューから集め、同じ画像ごとにまとめてモデルスレッドで推論する
+    
+    最初のリクエストから SEGMENT_BATCH_WINDOW_MS 経過するか SEGMENT_BATCH_SIZE 件集まった時点で処理する
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _segment_queue.get()]
+        deadline = loop.time() + SEGMENT_BATCH_WINDOW_MS / 1000
+        while len(batch) < SEGMENT_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_segment_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # 画像と multimask_output が同じリクエストごとにグループ化
+        groups: dict[tuple[bytes, bool], list] = {}
+        for request, image_hash, future in batch:
+            groups.setdefault((image_hash, request.multimask_output), []).append((request, future))
+        
+        for (image_hash, _), items in groups.items():
+            try:
+                results = await run_on_model_thread(
+                    run_segmentation_batch, [request for request, _ in items], image_hash
+                )
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+async def resolve_image_hash(request: SegmentationRequest) -> bytes:
+    """
+    リクエストの画像ハッシュを取得
+    
+    クライアントが送った image_hash がキャッシュ済みの画像を指していればそのまま使い、
+    Base64 文字列全体のハッシュ計算を省く。不明なハッシュは信用せず画像から計算する
+    """
+    if request.image_hash:
+        try:
+            image_hash = bytes.fromhex(request.image_hash)
+        except ValueError:
+            image_hash = None
+        if image_hash is not None and (image_hash == _current_image_hash or image_hash in _feature_cache):
+            return image_hash
+    return await run_in_threadpool(get_image_hash, request.image)
+
+
+def snap_points(points: list[tuple[float, float]]) -> tuple[tuple[int, int], ...]:
+    """ポイント座標を整数に丸めてタプル化（結果キャッシュのキー用）"""
+    return tuple((round(p[0]), round(p[1])) for p in points)
+
+
+async def run_segmentation(request: SegmentationRequest) -> tuple[np.ndarray, np.ndarray]:
+    """
+    ポイントセグメンテーションを実行（バッチ有効時はキュー経由でまとめて推論）
+    
+    同じ画像・同じポイントの結果はキャッシュから返す（イベントループ上でのみ読み書きする）
+    """
+    image_hash = await resolve_image_hash(request)
+    cache_key = (
+        image_hash,
+        request.multimask_output,
+        snap_points(request.points_positive),
+        snap_points(request.points_negative),
+    )
+    cached = _result_cache.get(cache_key)
+    if cached is not None:
+        _result_cache.move_to_end(cache_key)
+        return cached
+    
+    if _segment_queue is None:
+        results = await run_on_model_thread(run_segmentation_batch, [request], image_hash)
+        result = results[0]
+    else:
+        future = asyncio.get_running_loop().create_future()
+        await _segment_queue.put((request, image_hash, future))
+        result = await future
+    
+    _result_cache[cache_key] = result
+    while len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+    return result
+
+
 @app.post("/segment", response_model=SegmentationResponse)
 async def segment(request: SegmentationRequest):
     """
     ポイントプロンプトによるセグメンテーション
     
     画像とポイント座標を受け取り、マスクを生成して返します。
+    画像を RGB で送ると、サーバー側のモード変換が省略されます。
     
     Args:
         image: Base64エンコードされた画像
@@ -352,131 +939,70 @@ async def segment(request: SegmentationRequest):
         masks: Base64エンコードされたマスク画像のリスト
         scores: 各マスクのスコア
     """
-    global _current_image_state, _current_image_hash
+    if len(request.points_positive) + len(request.points_negative) == 0:
+        return SegmentationResponse(
+            success=False,
+            message="No points provided",
+        )
     
     # SAM3が利用できない場合はフォールバックマスクを生成
     if not _sam3_available or _model is None or _processor is None:
-        return generate_fallback_mask(request)
+        return await run_in_threadpool(generate_fallback_mask, request)
     
-    try:
-        import torch
-        
-        # 画像デコード
-        image = decode_base64_image(request.image)
-        image_hash = get_image_hash(image)
-        
-        # 画像が変更された場合はエンベディングを再計算
-        if _current_image_hash != image_hash:
-            logger.info("New image detected, computing embeddings...")
-            
-            # SAM1 (SamPredictor) の場合
-            from segment_anything import SamPredictor
-            if isinstance(_processor, SamPredictor):
-                image_np = np.array(image)
-                _processor.set_image(image_np)
-                _current_image_state = True
-            else:
-                _current_image_state = _processor.set_image(image)
-            
-            _current_image_hash = image_hash
-        
-        # ポイント座標を準備
-        all_points = request.points_positive + request.points_negative
-        if len(all_points) == 0:
-            return SegmentationResponse(
-                success=False,
-                message="No points provided",
-            )
-        
-        point_coords = np.array(all_points)
-        point_labels = np.array(
-            [1] * len(request.points_positive) + [0] * len(request.points_negative)
-        )
-        
-        logger.info(f"Segmenting with {len(request.points_positive)} positive, {len(request.points_negative)} negative points")
-        
-        # セグメンテーション実行
-        with torch.inference_mode():
-            # SAM1 (SamPredictor) の場合
-            from segment_anything import SamPredictor
-            if isinstance(_processor, SamPredictor):
-                # SAM1 API: predict()
-                masks, scores, logits = _processor.predict(
-                    point_coords=point_coords,
-                    point_labels=point_labels,
-                    multimask_output=request.multimask_output,
-                )
-            else:
-                # SAM3 API: predict_inst()
-                masks, scores, logits = _model.predict_inst(
-                    _current_image_state,
-                    point_coords=point_coords,
-                    point_labels=point_labels,
-                    multimask_output=request.multimask_output,
-                )
-        
-        # スコア順にソート
-        sorted_indices = np.argsort(scores)[::-1]
-        masks = masks[sorted_indices]
-        scores = scores[sorted_indices]
-        
-        # マスクをBase64エンコード
-        encoded_masks = [encode_mask_to_base64(mask) for mask in masks]
-        
-        return SegmentationResponse(
-            success=True,
-            masks=encoded_masks,
-            scores=scores.tolist(),
-            message=f"Generated {len(masks)} mask(s)",
-        )
-        
-    except Exception as e:
-        logger.error(f"Error during segmentation: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
+    masks, scores = await run_segmentation(request)
+    
+    # マスクのエンコードはモデルスレッドの外で行い、次のリクエストの推論を待たせない
+    encoded_masks, mask_shape = await run_in_threadpool(encode_masks, masks, request.mask_format)
+    
+    return SegmentationResponse(
+        success=True,
+        masks=encoded_masks,
+        scores=scores.tolist(),
+        mask_shape=mask_shape,
+        message=f"Generated {len(masks)} mask(s)",
+    )
 
 
 def generate_fallback_mask(request: SegmentationRequest) -> SegmentationResponse:
     """SAM3が利用できない場合のフォールバックマスク生成"""
     try:
-        # 画像デコード
-        image = decode_base64_image(request.image)
+        # 画像デコード（同じ画像が続く場合はキャッシュから取得）
+        image = decode_base64_image_cached(request.image)
         width, height = image.size
         
-        # ポイント座標を準備
-        all_points = request.points_positive + request.points_negative
-        if len(all_points) == 0:
-            return SegmentationResponse(
-                success=False,
-                message="No points provided",
-            )
-        
         # フォールバックマスク生成（円形マスク）
-        mask = np.zeros((height, width), dtype=np.uint8)
-        
-        for pt in request.points_positive:
-            x, y = int(pt[0]), int(pt[1])
-            # 画像サイズに比例した半径
-            radius = int(min(width, height) * 0.15)
-            y_grid, x_grid = np.ogrid[:height, :width]
-            dist = np.sqrt((x_grid - x) ** 2 + (y_grid - y) ** 2)
-            mask[dist <= radius] = 255
-        
-        for pt in request.points_negative:
-            x, y = int(pt[0]), int(pt[1])
-            radius = int(min(width, height) * 0.1)
-            y_grid, x_grid = np.ogrid[:height, :width]
-            dist = np.sqrt((x_grid - x) ** 2 + (y_grid - y) ** 2)
-            mask[dist <= radius] = 0
+        # 座標グリッドは一度だけ作り、ポイントごとに H×W の判定結果を OR で積み上げる
+        # （sqrt は使わず二乗距離で比較。(P, H, W) の距離配列は作らない。
+        # 画像外の座標が来ても二乗距離がオーバーフローしないよう int64 で計算する）
+        y_grid = np.arange(height, dtype=np.int64)[:, None]
+        x_grid = np.arange(width, dtype=np.int64)[None, :]
+        
+        def within_radius(points: list[tuple[float, float]], radius: int) -> np.ndarray:
+            r2 = radius * radius
+            hit = np.zeros((height, width), dtype=bool)
+            for p in points:
+                dx = x_grid - int(p[0])
+                dy = y_grid - int(p[1])
+                hit |= (dx * dx + dy * dy) <= r2
+            return hit
+        
+        # 画像サイズに比例した半径
+        if request.points_positive:
+            mask = within_radius(request.points_positive, int(min(width, height) * 0.15)).astype(np.uint8) * 255
+        else:
+            mask = np.zeros((height, width), dtype=np.uint8)
+        
+        if request.points_negative:
+            mask[within_radius(request.points_negative, int(min(width, height) * 0.1))] = 0
         
         # マスクをエンコード
-        encoded_mask = encode_mask_to_base64(mask)
+        encoded_masks, mask_shape = encode_masks([mask], request.mask_format)
         
         return SegmentationResponse(
             success=True,
-            masks=[encoded_mask],
+            masks=encoded_masks,
             scores=[0.5],  # フォールバックスコア
+            mask_shape=mask_shape,
             message="Fallback mask generated (SAM3 not available)",
         )
         
@@ -488,43 +1014,21 @@ def generate_fallback_mask(request: SegmentationRequest) -> SegmentationResponse
         )
 
 
-@app.post("/segment_with_text", response_model=SegmentationResponse)
-async def segment_with_text(image: str, prompt: str, confidence_threshold: float = 0.5):
-    """
-    テキストプロンプトによるセグメンテーション
-    
-    Args:
-        image: Base64エンコードされた画像
-        prompt: テキストプロンプト (例: "person", "dog", "car")
-        confidence_threshold: 信頼度閾値
-    
-    Returns:
-        masks: Base64エンコードされたマスク画像のリスト
-        scores: 各マスクのスコア
-    """
-    global _current_image_state, _current_image_hash
-    
-    if _model is None or _processor is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-    
+def run_text_segmentation(image: str, prompt: str, confidence_threshold: float) -> SegmentationResponse:
+    """テキストプロンプトによるセグメンテーションを実行（ワーカースレッドで実行）"""
     try:
-        # 画像デコード
-        pil_image = decode_base64_image(image)
-        image_hash = get_image_hash(pil_image)
-        
-        # 画像が変更された場合はエンベディングを再計算
-        if _current_image_hash != image_hash:
-            logger.info("New image detected, computing embeddings...")
-            _current_image_state = _processor.set_image(pil_image)
-            _current_image_hash = image_hash
+        # 画像が変更された場合のみデコードしてエンベディングを再計算（キャッシュにあれば復元）
+        image_hash = get_image_hash(image)
+        activate_image(image, image_hash)
         
         # テキストプロンプトでセグメンテーション
         logger.info(f"Segmenting with text prompt: '{prompt}'")
-        _processor.reset_all_prompts(_current_image_state)
-        output = _processor.set_text_prompt(
-            state=_current_image_state,
-            prompt=prompt,
-        )
+        with inference_context():
+            _processor.reset_all_prompts(_current_image_state)
+            output = _processor.set_text_prompt(
+                state=_current_image_state,
+                prompt=prompt,
+            )
         
         masks = output.get("masks", [])
         scores = output.get("scores", [])
@@ -542,23 +1046,45 @@ async def segment_with_text(image: str, prompt: str, confidence_threshold: float
         filtered_scores = []
         for mask, score in zip(masks, scores):
             if score >= confidence_threshold:
-                filtered_masks.append(encode_mask_to_base64(mask))
+                filtered_masks.append(mask)
                 filtered_scores.append(float(score))
         
+        encoded_masks, _ = encode_masks(filtered_masks, "png")
+        
         return SegmentationResponse(
             success=True,
-            masks=filtered_masks,
+            masks=encoded_masks,
             scores=filtered_scores,
             message=f"Found {len(filtered_masks)} object(s)",
         )
         
     except Exception as e:
-        logger.error(f"Error during text segmentation: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error during text segmentation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/segment_with_text", response_model=SegmentationResponse)
+async def segment_with_text(image: str, prompt: str, confidence_threshold: float = 0.5):
+    """
+    テキストプロンプトによるセグメンテーション
+    
+    Args:
+        image: Base64エンコードされた画像
+        prompt: テキストプロンプト (例: "person", "dog", "car")
+        confidence_threshold: 信頼度閾値
+    
+    Returns:
+        masks: Base64エンコードされたマスク画像のリスト
+        scores: 各マスクのスコア
+    """
+    if _model is None or _processor is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    return await run_on_model_thread(
+        run_text_segmentation, image, prompt, confidence_threshold
+    )
+
+
 # ========================================
 # メイン
 # ========================================
@@ -11,13 +11,20 @@ Modal上のGPUで動作するSAM3D 3Dモデル生成サーバー
     modal deploy sam3d_modal.py
 """
 
-import base64
 import io
+import json
 import os
 from typing import Optional
 
 import modal
 
+# Base64 のエンコード・デコードは pybase64 (SIMD 対応) を優先
+# （ローカル実行時など未インストールなら標準ライブラリ）
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 # Modal App定義
 app = modal.App("sam3d-generation-server")
 
@@ -50,6 +57,8 @@ sam3d_image = (
         "pillow",
         "fastapi[standard]",
         "pydantic",
+        "msgpack",
+        "pybase64",
         
         # SAM3D コア依存
         "omegaconf",
@@ -62,6 +71,7 @@ sam3d_image = (
         "scikit-image",
         "opencv-python-headless",
         "huggingface_hub",
+        "hf_transfer",  # チェックポイントの並列チャンクダウンロード用
         "safetensors",
         "accelerate",
         "transformers",
@@ -136,12 +146,102 @@ sam3d_image = (
     .run_commands(
         "TORCH_CUDA_ARCH_LIST='8.0' CUDA_HOME=/usr/local/cuda pip install 'git+https://github.com/nerfstudio-project/gsplat.git' --no-build-isolation"
     )
+    # 大きなチェックポイントファイルを hf_transfer で分割して並列ダウンロードする
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
 )
 
 # 共有ボリューム（チェックポイント保存用）
 volume = modal.Volume.from_name("sam3d-checkpoints", create_if_missing=True)
 CHECKPOINT_PATH = "/checkpoints"
 
+# SAM3D パイプラインを torch.compile するかどうか（コンパイルはセットアップ時のウォームアップで済ませる）
+COMPILE_ENABLED = os.environ.get("SAM3D_COMPILE", "1") == "1"
+# ウォームアップ用ダミー画像のサイズ
+WARMUP_IMAGE_SIZE = 512
+# 画像・マスク1枚あたりの最大サイズ（Base64 文字列または生の bytes の長さ）
+MAX_IMAGE_PAYLOAD_BYTES = 50 * 1024 * 1024
+# リクエストボディ全体の最大サイズ（/generate_multi の複数マスク分を含む）
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+# モデル未ロード時の失敗メッセージ（/generate_stream ではサーバーエラーではなく 503 として返す）
+MODEL_NOT_LOADED_MESSAGE = "SAM3D model not loaded"
+# /generate_stream で1回に送るチャンクサイズ
+STREAM_CHUNK_SIZE = 1024 * 1024
+# CUDA アロケータの設定（メッシュ生成段のピーク時にも断片化で OOM にならないようにする）
+CUDA_ALLOC_CONF = "expandable_segments:True,max_split_size_mb:512"
+# 確保済みだが未使用の GPU メモリがこれを超えたら生成後にキャッシュを解放する
+EMPTY_CACHE_THRESHOLD_BYTES = 2 * 1024**3
+# コンパイル済みカーネルのキャッシュ（ボリュームに置き、コールドスタート時に再利用する）
+COMPILE_CACHE_DIRS = {
+    "TORCHINDUCTOR_CACHE_DIR": f"{CHECKPOINT_PATH}/inductor_cache",
+    "TRITON_CACHE_DIR": f"{CHECKPOINT_PATH}/triton_cache",
+    "CUDA_CACHE_PATH": f"{CHECKPOINT_PATH}/nv_compute_cache",
+}
+# 推論全体を bfloat16 autocast で実行するかどうか
+# パイプラインは段ごとに精度を管理しており、レンダリング・エクスポート系の演算が
+# bfloat16 に対応しない場合があるため、出力を確認した上で有効化する
+AUTOCAST_ENABLED = os.environ.get("SAM3D_AUTOCAST", "0") == "1"
+
+
+def convert_conv3d_channels_last(pipeline) -> int:
+    """
+    パイプラインが保持するモデル内の Conv3d の重みを channels_last_3d (NDHWC) に変換
+    
+    重みが NDHWC なら cuDNN は出力も NDHWC で返すため、以降の Conv3d の前後で
+    レイアウト変換カーネルが挟まらなくなる。
+    
+    Returns:
+        変換した Conv3d の数
+    """
+    import torch
+    
+    modules = []
+    for value in vars(pipeline).values():
+        if isinstance(value, torch.nn.Module):
+            modules.append(value)
+        elif isinstance(value, dict):
+            modules.extend(v for v in value.values() if isinstance(v, torch.nn.Module))
+    
+    converted = 0
+    for module in modules:
+        for m in module.modules():
+            if isinstance(m, torch.nn.Conv3d):
+                m.weight.data = m.weight.data.contiguous(memory_format=torch.channels_last_3d)
+                converted += 1
+    return converted
+
+
+# save_ply() がファイルオブジェクトを受け付けるかどうか（最初の呼び出しで判定）
+_save_ply_accepts_buffer = True
+
+
+def export_ply(gaussians) -> bytes:
+    """
+    Gaussian を PLY のバイト列として書き出す
+    
+    save_ply() がファイルオブジェクトを受け付ければ BytesIO に直接書き込む。
+    パスしか受け付けない場合は一時ファイルを経由するが、
+    tmpfs (/dev/shm) があればそこに置いてディスク I/O を避ける
+    """
+    global _save_ply_accepts_buffer
+    import tempfile
+    
+    if _save_ply_accepts_buffer:
+        buffer = io.BytesIO()
+        try:
+            gaussians.save_ply(buffer)
+            return buffer.getvalue()
+        except (TypeError, AttributeError):
+            # os.path 系の関数にパスとして渡された場合など
+            print("save_ply() does not accept a file object, using a temporary file")
+            _save_ply_accepts_buffer = False
+    
+    tmp_root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=tmp_root) as tmpdir:
+        output_path = f"{tmpdir}/output.ply"
+        gaussians.save_ply(output_path)
+        with open(output_path, "rb") as f:
+            return f.read()
+
 
 @app.cls(
     image=sam3d_image,
@@ -150,17 +250,39 @@ CHECKPOINT_PATH = "/checkpoints"
     volumes={CHECKPOINT_PATH: volume},
     secrets=[modal.Secret.from_name("huggingface-secret")],
 )
+# 2件までのリクエストを同じウォーム済みコンテナで受け付ける（新しいコンテナを起動させない）。
+# GPU 推論は gpu_lock で1件ずつに直列化し、入力のデコードだけを並行させる
+@modal.concurrent(max_inputs=2)
 class SAM3DGenerator:
     """SAM3D 3Dモデル生成クラス"""
     
     @modal.enter()
     def setup(self):
         """モデルの初期化"""
+        import gc
         import os
         import sys
+        import threading
+        
+        # torch の import 前にキャッシュの場所とアロケータの設定を行う
+        for env_name, cache_dir in COMPILE_CACHE_DIRS.items():
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault(env_name, cache_dir)
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", CUDA_ALLOC_CONF)
+        
         import torch
+        import numpy as np
+        from PIL import Image
         from huggingface_hub import hf_hub_download, snapshot_download
         
+        # リクエスト処理で使うモジュールはここで一度だけ解決しておく
+        self.torch = torch
+        self.np = np
+        self.Image = Image
+        # パイプラインはリクエストごとに内部状態（rendering_engine など）を書き換え、
+        # ピーク VRAM も大きいため、同時に受け付けたリクエストでも推論は1件ずつ行う
+        self.gpu_lock = threading.Lock()
+        
         print("Setting up SAM3D Generator...")
         
         # CONDA_PREFIX環境変数のフォールバック（SAM3Dが参照する）
@@ -189,10 +311,12 @@ class SAM3DGenerator:
         elif hf_token:
             print("Downloading SAM3D checkpoints from HuggingFace...")
             try:
+                # ファイル単位でも並列にダウンロード（ボリュームに揃っていればこの処理自体を通らない）
                 snapshot_download(
                     repo_id="facebook/sam-3d-objects",
                     local_dir=hf_repo_dir,
                     token=hf_token,
+                    max_workers=16,
                 )
                 volume.commit()
                 print(f"Repository downloaded to {hf_repo_dir}")
@@ -253,7 +377,47 @@ class SAM3DGenerator:
                 self.error_message = f"Config file not found: {config_path}"
                 return
             
-            self.inference = Inference(config_path, compile=False)
+            self.inference = Inference(config_path, compile=COMPILE_ENABLED)
+            
+            num_conv3d = convert_conv3d_channels_last(self.inference._pipeline)
+            print(f"Converted {num_conv3d} Conv3d layer(s) to channels_last_3d")
+            
+            # 入力形状ごとに最速の畳み込みアルゴリズムを選択して再利用する
+            torch.backends.cudnn.benchmark = True
+            # FP32 の行列積・畳み込みに TF32 の Tensor Core を使う（A100）
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+            # Transformer の scaled_dot_product_attention で FlashAttention カーネルを使う
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+            
+            # 最初のリクエストでコンパイル・cuDNN のアルゴリズム選択・CUDA 初期化の待ちが
+            # 発生しないよう、ダミー入力で一度推論しておく
+            warmup_failed = False
+            try:
+                self.warmup()
+            except Exception as e:
+                print(f"Warmup failed: {e}")
+                warmup_failed = True
+            
+            if warmup_failed and COMPILE_ENABLED:
+                # コンパイルに失敗した可能性があるため eager モードで読み直す。
+                # 失敗したパイプラインの重みを先に解放し、GPU 上に2組載らないようにする
+                # （except 節の外で行い、例外のトレースバックが参照するテンソルも解放させる）
+                print("Falling back to eager mode")
+                self.inference = None
+                gc.collect()
+                torch.cuda.empty_cache()
+                self.inference = Inference(config_path, compile=False)
+                convert_conv3d_channels_last(self.inference._pipeline)
+            
+            # ウォームアップで生成されたカーネルキャッシュを次回以降のコンテナと共有
+            try:
+                volume.commit()
+            except Exception as e:
+                print(f"Failed to commit compile caches: {e}")
+            
             self.ready = True
             print("SAM3D model loaded successfully!")
         except Exception as e:
@@ -264,70 +428,88 @@ class SAM3DGenerator:
             self.inference = None
             self.error_message = str(e)
     
-    @modal.method()
-    def generate_3d(
-        self,
-        image_base64: str,
-        mask_base64: str,
-        seed: int = 42,
-        output_format: str = "ply",  # "ply" or "glb"
-    ) -> dict:
+    def inference_context(self):
         """
-        3Dモデルを生成
+        推論呼び出しを囲むコンテキスト（ウォームアップと本番で同じ条件にする）
         
-        Args:
-            image_base64: Base64エンコードされた元画像
-            mask_base64: Base64エンコードされたマスク画像
-            seed: ランダムシード
-            output_format: 出力形式 ("ply" or "glb")
+        勾配の記録を無効化する。レイアウト後処理などパイプライン内部で
+        enable_grad() を使う箇所があっても動作するよう、inference_mode ではなく no_grad を使う
+        """
+        import contextlib
+        import torch
+        
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.no_grad())
+        if AUTOCAST_ENABLED:
+            stack.enter_context(torch.autocast("cuda", dtype=torch.bfloat16))
+        return stack
+    
+    def warmup(self):
+        """ダミー画像とマスクで推論を1回実行（コンパイル・カーネル選択を事前に済ませる）"""
+        np = self.np
+        
+        size = WARMUP_IMAGE_SIZE
+        dummy_image = np.full((size, size, 3), 128, dtype=np.uint8)
+        dummy_mask = np.zeros((size, size), dtype=np.uint8)
+        dummy_mask[size // 4 : size * 3 // 4, size // 4 : size * 3 // 4] = 1
+        
+        print("Warming up SAM3D inference...")
+        with self.inference_context():
+            self.inference(dummy_image, dummy_mask, seed=0)
+        print("Warmup complete")
+    
+    def decode_inputs(self, image_data, mask_data):
+        """
+        画像とマスクをデコードし、パイプライン入力の numpy 配列に変換
         
         Returns:
-            dict: {
-                "success": bool,
-                "model_data": str (Base64エンコードされた3Dモデル),
-                "format": str,
-                "message": str
-            }
+            (RGB 画像 [H, W, 3] uint8, 0/1 のマスク [H, W] uint8)
         """
-        import numpy as np
-        from PIL import Image
-        import io
-        import tempfile
+        np = self.np
+        Image = self.Image
         
-        if not self.ready or self.inference is None:
-            return {
-                "success": False,
-                "model_data": "",
-                "format": output_format,
-                "message": "SAM3D model not loaded"
-            }
+        def decode_image(data):
+            # bytes はBase64エンコードされていない生の画像データ（msgpack リクエスト）
+            if isinstance(data, bytes):
+                img_bytes = data
+            else:
+                # data:image/xxx;base64, プレフィックスを除去（split のようにリストを作らない）
+                data = data.partition(",")[2] or data
+                img_bytes = base64.b64decode(data)
+            img = Image.open(io.BytesIO(img_bytes))
+            # ここでデコードを済ませ、BytesIO と圧縮データへの参照を早めに手放す
+            img.load()
+            return img
         
-        try:
-            # Base64デコード
-            def decode_image(b64_str):
-                if "," in b64_str:
-                    b64_str = b64_str.split(",")[1]
-                img_bytes = base64.b64decode(b64_str)
-                return Image.open(io.BytesIO(img_bytes))
-            
-            image = decode_image(image_base64)
-            mask_img = decode_image(mask_base64)
-            
-            # 画像をnumpy配列に変換
-            image_np = np.array(image.convert("RGB"))
-            
-            # マスクをバイナリに変換
-            mask_np = np.array(mask_img.convert("L"))
-            mask_binary = (mask_np > 127).astype(np.uint8)
-            
-            print(f"Input image size: {image_np.shape}")
-            print(f"Mask size: {mask_binary.shape}")
-            
+        image = decode_image(image_data)
+        mask_img = decode_image(mask_data)
+        
+        # 既に目的のモードなら変換（全画素のコピー）を省略
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if mask_img.mode != "L":
+            mask_img = mask_img.convert("L")
+        
+        # 画像をnumpy配列に変換
+        # （PIL の画素は tobytes() 経由で1回コピーされ読み取り専用配列になる。np.array と違い2回目のコピーはしない）
+        image_np = np.asarray(image)
+        
+        # マスクをバイナリに変換
+        # 比較結果の bool 配列を uint8 として再解釈する（0/1 のまま、astype のコピーなし）
+        mask_binary = np.greater(np.asarray(mask_img), 127).view(np.uint8)
+        
+        print(f"Input image size: {image_np.shape}")
+        print(f"Mask size: {mask_binary.shape}")
+        return image_np, mask_binary
+    
+    def run_pipeline(self, image_np, mask_binary, seed: int, output_format: str) -> dict:
+        """SAM3D推論を実行"""
+        with self.inference_context():
             # SAM3D推論実行（GLB出力）
             if output_format == "glb":
                 # use_vertex_color=True + with_mesh_postprocess=False でnvdiffrastを回避
                 self.inference._pipeline.rendering_engine = "pytorch3d"
-                output = self.inference._pipeline.run(
+                return self.inference._pipeline.run(
                     self.inference.merge_mask_to_rgba(image_np, mask_binary),
                     None,
                     seed,
@@ -339,48 +521,110 @@ class SAM3DGenerator:
                     stage1_inference_steps=None,
                     pointmap=None,
                 )
+            return self.inference(image_np, mask_binary, seed=seed)
+    
+    def export_output(self, output: dict, output_format: str, encode_base64: bool) -> dict:
+        """推論結果を3Dモデルファイルのバイト列にエクスポートして結果の dict を作る"""
+        # 3Dモデルをエクスポート（GLB はファイルを介さずメモリ上でバイト列にする）
+        model_bytes = None
+        if output_format == "glb":
+            if "glb" in output and output["glb"] is not None:
+                model_bytes = output["glb"].export(file_type="glb")
+            elif "mesh" in output and output["mesh"] is not None:
+                model_bytes = output["mesh"][0].export(file_type="glb")
             else:
-                output = self.inference(image_np, mask_binary, seed=seed)
-            
-            # 3Dモデルをエクスポート
-            with tempfile.TemporaryDirectory() as tmpdir:
-                if output_format == "ply":
-                    output_path = f"{tmpdir}/output.ply"
-                    output["gs"].save_ply(output_path)
-                else:
-                    # GLBエクスポート（glbオブジェクトがある場合）
-                    output_path = f"{tmpdir}/output.glb"
-                    if "glb" in output and output["glb"] is not None:
-                        output["glb"].export(output_path)
-                    elif "mesh" in output and output["mesh"] is not None:
-                        output["mesh"][0].export(output_path)
-                    else:
-                        # PLYにフォールバック
-                        print("GLB/mesh not available, falling back to PLY")
-                        output_path = f"{tmpdir}/output.ply"
-                        output["gs"].save_ply(output_path)
-                        output_format = "ply"
-                
-                # ファイルをBase64エンコード
-                with open(output_path, "rb") as f:
-                    model_data = base64.b64encode(f.read()).decode("utf-8")
-            
-            return {
-                "success": True,
-                "model_data": model_data,
-                "format": output_format,
-                "message": "3D model generated successfully"
+                # PLYにフォールバック
+                print("GLB/mesh not available, falling back to PLY")
+                output_format = "ply"
+        if model_bytes is None:
+            model_bytes = export_ply(output["gs"])
+        
+        # Base64エンコード（バイナリで返せる呼び出し元にはエンコードとコピーを省く）
+        if encode_base64:
+            model_data = base64.b64encode(model_bytes).decode("ascii")
+        else:
+            model_data = model_bytes
+        
+        return {
+            "success": True,
+            "model_data": model_data,
+            "format": output_format,
+            "message": "3D model generated successfully"
+        }
+    
+    @staticmethod
+    def failure(output_format: str, message: str) -> dict:
+        """失敗時の結果 dict"""
+        return {
+            "success": False,
+            "model_data": "",
+            "format": output_format,
+            "message": message,
+        }
+    
+    # health_check / debug_info と同じクラスに置くため @modal.batched は使わない
+    # （Modal は batched メソッドを持つクラスに他のメソッドを許可しない）。
+    # パイプラインはバッチ推論に対応しておらず、バッチ化しても GPU 推論は1件ずつになる
+    @modal.method()
+    def generate_3d(
+        self,
+        image_base64,
+        mask_base64,
+        seed: int = 42,
+        output_format: str = "ply",  # "ply" or "glb"
+        encode_base64: bool = True,
+    ) -> dict:
+        """
+        3Dモデルを生成
+        
+        Args:
+            image_base64: Base64エンコードされた元画像（bytes の場合は生の画像データ）
+            mask_base64: Base64エンコードされたマスク画像（bytes の場合は生の画像データ）
+            seed: ランダムシード
+            output_format: 出力形式 ("ply" or "glb")
+            encode_base64: False の場合、モデルデータを Base64 にせず bytes のまま返す
+        
+        Returns:
+            dict: {
+                "success": bool,
+                "model_data": str (Base64エンコードされた3Dモデル) または bytes,
+                "format": str,
+                "message": str
             }
-            
+        """
+        if not self.ready or self.inference is None:
+            return self.failure(output_format, MODEL_NOT_LOADED_MESSAGE)
+        
+        try:
+            # デコードはロックの外で行い、もう1件の推論と重ねる
+            image_np, mask_binary = self.decode_inputs(image_base64, mask_base64)
+            with self.gpu_lock:
+                output = self.run_pipeline(image_np, mask_binary, seed, output_format)
+                del image_np, mask_binary
+                result = self.export_output(output, output_format, encode_base64)
+                # 推論結果を解放してから断片化を測る（参照が残ると未使用分が過小に見える）
+                del output
+                self.release_cached_memory()
         except Exception as e:
             import traceback
             traceback.print_exc()
-            return {
-                "success": False,
-                "model_data": "",
-                "format": output_format,
-                "message": str(e)
-            }
+            result = self.failure(output_format, str(e))
+        
+        return result
+    
+    def release_cached_memory(self):
+        """
+        断片化で未使用のまま確保されている GPU メモリが多い場合のみキャッシュを解放
+        
+        empty_cache() は次の推論で確保し直すコストがかかるため毎回は呼ばない
+        """
+        torch = self.torch
+        if not torch.cuda.is_available():
+            return
+        unused = torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        if unused > EMPTY_CACHE_THRESHOLD_BYTES:
+            print(f"Releasing {unused / 1024**3:.1f} GB of cached GPU memory")
+            torch.cuda.empty_cache()
     
     @modal.method()
     def health_check(self) -> dict:
@@ -438,10 +682,14 @@ class SAM3DGenerator:
     image=sam3d_image,
     timeout=600,
 )
+# GPU 処理は SAM3DGenerator 側で行うため、1つの Web コンテナで複数リクエストを並行して受け付ける
+@modal.concurrent(max_inputs=32)
 @modal.asgi_app()
 def web_app():
     """FastAPI Web アプリケーション"""
-    from fastapi import FastAPI, HTTPException
+    import msgpack
+    from fastapi import FastAPI, HTTPException, Request, Response
+    from fastapi.responses import JSONResponse, StreamingResponse
     from fastapi.middleware.cors import CORSMiddleware
     from pydantic import BaseModel
     
@@ -451,6 +699,16 @@ def web_app():
         version="0.1.0",
     )
     
+    # 後から追加したミドルウェアほど外側になるため、CORS より先に登録して
+    # 413 レスポンスにも CORS ヘッダーが付くようにする（付かないとブラウザでは通信エラーに見える）
+    @api.middleware("http")
+    async def limit_request_size(request: Request, call_next):
+        """Content-Length が上限を超えるリクエストはボディを読み込む前に 413 で拒否"""
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+            return JSONResponse(status_code=413, content={"detail": "Request body too large"})
+        return await call_next(request)
+    
     api.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -459,6 +717,15 @@ def web_app():
         allow_headers=["*"],
     )
     
+    def check_payload_size(*payloads):
+        """画像・マスクが上限を超えていればデコード前に 413 で拒否"""
+        for payload in payloads:
+            if len(payload) > MAX_IMAGE_PAYLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image or mask payload too large")
+    
+    # GPU クラスのハンドルはコンテナ起動時に1回だけ作り、全エンドポイントで共有する
+    generator = SAM3DGenerator()
+    
     class GenerateRequest(BaseModel):
         image: str  # Base64エンコードされた画像
         mask: str   # Base64エンコードされたマスク
@@ -471,6 +738,23 @@ def web_app():
         format: str = "ply"
         message: str = ""
     
+    # msgpack リクエストでは image / mask に生の画像 bytes を受け付ける
+    class MaskItem(BaseModel):
+        mask: str | bytes   # Base64エンコードされたマスク
+        name: str   # オブジェクト名（レスポンスの対応付け用）
+    
+    class GenerateMultiRequest(BaseModel):
+        image: str | bytes  # Base64エンコードされた画像（全マスクで共有）
+        masks: list[MaskItem]
+        seed: int = 42
+        output_format: str = "ply"
+    
+    class GenerateMultiItem(GenerateResponse):
+        name: str
+    
+    class GenerateMultiResponse(BaseModel):
+        results: list[GenerateMultiItem]
+    
     class HealthResponse(BaseModel):
         status: str
         service: str
@@ -481,26 +765,123 @@ def web_app():
     
     @api.get("/health", response_model=HealthResponse)
     async def health():
-        generator = SAM3DGenerator()
-        return generator.health_check.remote()
+        return await generator.health_check.remote.aio()
     
     @api.get("/debug")
     async def debug():
         """詳細デバッグ情報"""
-        generator = SAM3DGenerator()
-        return generator.debug_info.remote()
+        return await generator.debug_info.remote.aio()
     
     @api.post("/generate", response_model=GenerateResponse)
     async def generate(request: GenerateRequest):
-        generator = SAM3DGenerator()
-        result = generator.generate_3d.remote(
-            image_base64=request.image,
-            mask_base64=request.mask,
-            seed=request.seed,
-            output_format=request.output_format,
+        """
+        画像とマスクから3Dモデルを生成
+        
+        画像は RGB、マスクはグレースケール (L) の PNG/JPEG で送ると、
+        サーバー側のモード変換が省略される
+        """
+        check_payload_size(request.image, request.mask)
+        result = await generator.generate_3d.remote.aio(
+            request.image,
+            request.mask,
+            request.seed,
+            request.output_format,
+            True,
         )
         return result
     
+    @api.post("/generate_stream")
+    async def generate_stream(request: GenerateRequest):
+        """
+        画像とマスクから3Dモデルを生成し、モデルファイルをバイナリのまま分割送信
+        
+        /generate と違い Base64 + JSON に包まないため、クライアントは全体を
+        メモリに保持せずに受信したチャンクから順にファイルへ書き込める。
+        実際の出力形式（GLB が使えず PLY にフォールバックした場合など）は
+        X-Model-Format ヘッダーで返す
+        """
+        check_payload_size(request.image, request.mask)
+        result = await generator.generate_3d.remote.aio(
+            request.image,
+            request.mask,
+            request.seed,
+            request.output_format,
+            False,
+        )
+        if not result["success"]:
+            # モデル未ロードは一時的な利用不可なので 503、それ以外の失敗は 500
+            status_code = 503 if result["message"] == MODEL_NOT_LOADED_MESSAGE else 500
+            raise HTTPException(status_code=status_code, detail=result["message"])
+        
+        model_data = memoryview(result["model_data"])
+        
+        def iter_chunks():
+            for start in range(0, len(model_data), STREAM_CHUNK_SIZE):
+                yield model_data[start:start + STREAM_CHUNK_SIZE]
+        
+        return StreamingResponse(
+            iter_chunks(),
+            media_type="model/gltf-binary" if result["format"] == "glb" else "application/octet-stream",
+            headers={
+                "X-Model-Format": result["format"],
+                "Content-Length": str(len(model_data)),
+            },
+        )
+    
+    @api.post("/generate_multi", response_model=GenerateMultiResponse)
+    async def generate_multi(http_request: Request):
+        """
+        1枚の画像と複数マスクから3Dモデルを一括生成
+        
+        画像は1回だけアップロードされ、各マスクの生成はGPUコンテナへ並列に投入される。
+        Content-Type が application/msgpack の場合、画像は Base64 ではなく
+        生の bytes で受け取る（Base64 と巨大な JSON 文字列のパースを省略）。
+        Accept に application/msgpack を含む場合は、レスポンスも msgpack にして
+        モデルデータを Base64 にせず生の bytes で返す
+        """
+        body = await http_request.body()
+        try:
+            if http_request.headers.get("content-type", "").startswith("application/msgpack"):
+                payload = msgpack.unpackb(body, raw=False)
+            else:
+                payload = json.loads(body)
+            request = GenerateMultiRequest.model_validate(payload)
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid request body: {e}")
+        check_payload_size(request.image, *(item.mask for item in request.masks))
+        
+        raw_response = "application/msgpack" in http_request.headers.get("accept", "")
+        results = [
+            result
+            async for result in generator.generate_3d.starmap.aio(
+                [
+                    (request.image, item.mask, request.seed, request.output_format, not raw_response)
+                    for item in request.masks
+                ]
+            )
+        ]
+        if raw_response:
+            return Response(
+                content=msgpack.packb({
+                    "results": [
+                        {"name": item.name, **result}
+                        for item, result in zip(request.masks, results)
+                    ]
+                }),
+                media_type="application/msgpack",
+            )
+        return GenerateMultiResponse(
+            results=[
+                GenerateMultiItem(name=item.name, **result)
+                for item, result in zip(request.masks, results)
+            ]
+        )
+    
+    @api.get("/mock_health")
+    async def mock_health():
+        """疎通確認用（GPU コンテナを起こさない。旧 simple_server.py の代替）"""
+        return {"status": "ok", "message": "Server is running"}
+
     @api.get("/")
     async def root():
         return {"message": "SAM3D 3D Generation API", "docs": "/docs"}
@@ -520,9 +901,10 @@ def main():
     
     # テスト画像でテスト（オプション）
     # result = generator.generate_3d.remote(
-    #     image_base64="...",
-    #     mask_base64="...",
-    #     seed=42,
-    #     output_format="ply"
+    #     "...",  # image_base64
+    #     "...",  # mask_base64
+    #     42,     # seed
+    #     "ply",  # output_format
+    #     True,   # encode_base64
     # )
     # print(f"Result: {result}")
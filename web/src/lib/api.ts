@@ -14,12 +14,18 @@ export interface SegmentationRequest {
   points_positive: [number, number][];  // [[x, y], ...]
   points_negative?: [number, number][];
   multimask_output?: boolean;
+  // "png": PNG画像 (デフォルト), "packbits": 1ピクセル1ビットにパックした配列,
+  // "packbits_zlib": packbits を zlib 圧縮したもの (DecompressionStream("deflate") で展開)
+  mask_format?: "png" | "packbits" | "packbits_zlib";
+  // setImage() が返した image_hash。サーバーにキャッシュ済みならハッシュ計算を省略
+  image_hash?: string;
 }
 
 export interface SegmentationResponse {
   success: boolean;
-  masks: string[];  // Base64エンコードされたマスク画像
+  masks: string[];  // Base64エンコードされたマスク (mask_format に従う)
   scores: number[];
+  mask_shape?: [number, number];  // packbits / packbits_zlib 形式の場合 [height, width]
   message: string;
 }
 
@@ -30,6 +36,7 @@ export interface SetImageRequest {
 export interface SetImageResponse {
   success: boolean;
   image_size: [number, number];
+  image_hash?: string;  // segmentWithPoints() の image_hash に渡せる画像ハッシュ
   message: string;
 }
 
@@ -81,6 +88,8 @@ export async function segmentWithPoints(
       points_positive: request.points_positive,
       points_negative: request.points_negative || [],
       multimask_output: request.multimask_output ?? false,
+      mask_format: request.mask_format ?? "png",
+      image_hash: request.image_hash,
     }),
   });
 